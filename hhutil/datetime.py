@@ -1,11 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 
 from dateutil.parser import parse
-import pytz
+
+_SHANGHAI = timezone(timedelta(hours=8))
 
 
 def parse_datetime(dt):
-    dt = parse(dt)
+    # ISO 8601, including the output of format_datetime, is handled natively
+    try:
+        dt = datetime.fromisoformat(dt)
+    except (ValueError, TypeError):
+        dt = parse(dt)
     dt = dt.replace(tzinfo=None, microsecond=0)
     return dt
 
@@ -15,7 +20,7 @@ def format_datetime(dt: datetime):
 
 
 def datetime_now(format=False):
-    dt = datetime.now(tz=pytz.timezone("Asia/Shanghai"))
+    dt = datetime.now(_SHANGHAI)
     dt = dt.replace(tzinfo=None)
     if format:
         dt = format_datetime(dt)
@@ -1,19 +1,57 @@
+import os
+import sys
+import mmap
 import hashlib
+from functools import partial
 
 from hhutil.io import PathLike
 
-BUF_SIZE = 64 * 1024
+BUF_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 10 * 1024 * 1024
+
+_CTORS = {
+    'sha256': hashlib.sha256,
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+}
+
+def hash_ctor(method):
+    ctor = _CTORS.get(method)
+    if ctor is None:
+        # Raises ValueError for algorithms hashlib doesn't know
+        hashlib.new(method)
+        ctor = partial(hashlib.new, method)
+    return ctor
 
-def hash_file(fp: PathLike, method='sha256'):
-    obj = getattr(hashlib, method)()
 
+def hash_file(fp: PathLike, method='sha256'):
+    ctor = hash_ctor(method)
     with open(fp, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Not mappable (some FUSE/network mounts, special files), use the buffered path
+                mm = None
+            if mm is not None:
+                obj = ctor()
+                with mm:
+                    obj.update(mm)
+                return obj.hexdigest()
+
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, ctor).hexdigest()
+
+        obj = ctor()
+        buf = bytearray(BUF_SIZE)
+        view = memoryview(buf)
         while True:
-            data = f.read(BUF_SIZE)
-            if not data:
+            n = f.readinto(buf)
+            if not n:
                 break
-            obj.update(data)
-    
+            obj.update(view[:n])
+
     return obj.hexdigest()
 
 
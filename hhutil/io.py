@@ -7,15 +7,39 @@ import json
 import shutil
 import tempfile
 import zipfile
+import http.cookiejar
 import importlib.util
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import MappingProxyType
 from typing import Callable, Any, Union, Sequence
 from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 PathLike = Union[str, Path]
 
+_COPY_BUFSIZE = 1024 * 1024
+
+_GITHUB_RELEASE_RE = re.compile(
+    r"https://github.com/([a-zA-Z0-9]+)/([a-z0-9A-Z-_]+)/releases/download/([a-zA-Z0-9\.]+)/(.*)")
+_ONEDRIVE_RE = re.compile(r"https://1drv\.ms/u/s!([0-9a-zA-Z-_]{28})\?e=[0-9a-zA-Z-_]{6}")
+
+# Shared by every download in the process, including apply_dir worker threads.
+# The cookie jar never stores anything, so no state leaks between unrelated calls;
+# requests beyond pool_maxsize per host still work, their connections just aren't kept.
+_SESSION = requests.Session()
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
 
 def read_lines(fp: PathLike):
     return fmt_path(fp).read_text().splitlines()
@@ -35,18 +59,33 @@ def read_text(fp):
     return fmt_path(fp).read_text()
 
 
-def read_pickle(fp: PathLike):
+def read_pickle(fp: PathLike, *, buffers=None):
     with open(fp, 'rb') as f:
-        data = pickle.load(f)
+        if buffers is None:
+            data = pickle.load(f)
+        else:
+            data = pickle.load(f, buffers=buffers)
     return data
 
 
-def save_pickle(obj, fp: PathLike):
+def save_pickle(obj, fp: PathLike, *, buffers=None):
+    # Out-of-band buffers (protocol 5) are appended to `buffers` instead of being copied into the file
     with open(fp, 'wb') as f:
-        pickle.dump(obj, f)
+        if buffers is None:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            pickle.dump(obj, f, protocol=5, buffer_callback=buffers.append)
 
 
 def read_json(fp: PathLike):
+    if orjson is not None:
+        with open(fp, 'rb') as f:
+            data = f.read()
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN/Infinity literals written by json.dump
+            return json.loads(data)
     with open(fp) as f:
         data = json.load(f)
     return data
@@ -58,26 +97,60 @@ def save_json(obj, fp: PathLike):
 
 
 def fmt_path(fp: PathLike) -> Path:
+    if isinstance(fp, Path) and fp.is_absolute():
+        return fp
     return Path(fp).expanduser().absolute()
 
 
-def is_hidden(fp: PathLike):
-    fp = fmt_path(fp)
+_GLOB_MAGIC = re.compile(r'[*?[]')
+_DOTFILE_HIDDEN = sys.platform not in ['darwin', 'win32', 'cygwin']
+
+
+def _is_hidden(fp: str):
     plat = sys.platform
     if plat == 'darwin':
         import Foundation
-        url = Foundation.NSURL.fileURLWithPath_(str(fp))
+        url = Foundation.NSURL.fileURLWithPath_(fp)
         return url.getResourceValue_forKey_error_(None, Foundation.NSURLIsHiddenKey, None)[1]
     elif plat in ['win32', 'cygwin']:
-        return bool(fp.stat().st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
+        return bool(os.stat(fp).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
     else:
-        return fp.name.startswith(".")
+        return os.path.basename(fp).startswith(".")
+
+
+def is_hidden(fp: PathLike):
+    return _is_hidden(str(fmt_path(fp)))
+
+
+def _split_literal_prefix(pattern: str):
+    parts = pattern.split('/')
+    i = 0
+    while i < len(parts) and parts[i] and not _GLOB_MAGIC.search(parts[i]):
+        i += 1
+    if i < len(parts) and not parts[i]:
+        # Empty segment (leading, trailing or doubled '/'), leave it to glob
+        return [], pattern
+    return parts[:i], '/'.join(parts[i:])
 
 
 def eglob(fp: PathLike, pattern: str):
     fp = fmt_path(fp)
-    for f in fp.glob(pattern):
-        if not is_hidden(f):
+    prefix, pattern = _split_literal_prefix(pattern)
+    if prefix:
+        fp = fp.joinpath(*prefix)
+        if not pattern:
+            matches = [fp] if fp.exists() else []
+        elif not fp.is_dir():
+            return
+        else:
+            matches = fp.glob(pattern)
+    else:
+        matches = fp.glob(pattern)
+    for f in matches:
+        if _DOTFILE_HIDDEN:
+            if not f.name.startswith('.'):
+                yield f
+        elif not _is_hidden(str(f)):
             yield f
 
 
@@ -85,24 +158,38 @@ def rglob(dir: PathLike, pattern: str):
     pattern = re.compile(pattern)
     dir = fmt_path(dir)
     assert dir.exists() and dir.is_dir()
-    for f in dir.iterdir():
-        if not f.is_dir() and pattern.match(f.name):
-            yield f
+    with os.scandir(dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if pattern.match(entry.name) and not entry.is_dir():
+            yield Path(entry.path)
+
+
+def _iter_dir(dir: str, suffix, recursive):
+    # Snapshot the listing so callbacks that rename or create files don't see them again
+    with os.scandir(dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        elif entry.is_dir(follow_symlinks=False):
+            if recursive:
+                yield from _iter_dir(entry.path, suffix, recursive)
+        elif entry.is_file():
+            if suffix is None or os.path.splitext(entry.name)[1] == suffix:
+                yield Path(entry.path)
 
 
-def apply_dir(dir: PathLike, f: Callable[[PathLike], Any], suffix=None, recursive=True) -> None:
+def apply_dir(dir: PathLike, f: Callable[[PathLike], Any], suffix=None, recursive=True, *, workers=1) -> None:
     dir = fmt_path(dir)
-    for fp in dir.iterdir():
-        if fp.name.startswith('.'):
-            continue
-        elif fp.is_dir():
-            if recursive:
-                apply_dir(fp, f, recursive, suffix)
-        elif fp.is_file():
-            if suffix is None:
-                f(fp)
-            elif fp.suffix == suffix:
-                f(fp)
+    fps = _iter_dir(str(dir), suffix, recursive)
+    if workers > 1:
+        fps = list(fps)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(f, fps))
+    else:
+        for fp in fps:
+            f(fp)
 
 
 def rename(fp: PathLike, new_name: str, stem=True):
@@ -126,10 +213,8 @@ def mv(src: PathLike, dst: PathLike):
 def rm(fp: PathLike):
     fp = fmt_path(fp)
     if fp.exists():
-        if fp.is_dir():
-            for d in fp.iterdir():
-                rm(d)
-            fp.rmdir()
+        if fp.is_dir() and not fp.is_symlink():
+            shutil.rmtree(fp)
         else:
             fp.unlink()
 
@@ -147,38 +232,50 @@ def parse_python_config(fp: PathLike):
     return cfg
 
 
-def _zip_add_directory(zip_file, path, zip_path):
-    for item in sorted(os.listdir(path)):
-        current_path = os.path.join(path, item)
-        current_zip_path = os.path.join(zip_path, item)
-        if os.path.isfile(current_path):
-            _zip_add_file(zip_file, current_path, current_zip_path)
+# Already-compressed formats gain next to nothing from deflate
+_STORED_SUFFIXES = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst',
+}
+
+
+def _zip_compress_type(path):
+    if os.path.splitext(path)[1].lower() in _STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _zip_add_directory(zip_file, path, zip_path, compresslevel=6):
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        current_zip_path = os.path.join(zip_path, entry.name)
+        if entry.is_file():
+            _zip_add_file(zip_file, entry.path, current_zip_path, compresslevel)
         else:
-            _zip_add_directory(zip_file, current_path, current_zip_path)
+            _zip_add_directory(zip_file, entry.path, current_zip_path, compresslevel)
 
 
-def _zip_add_file(zip_file, path, zip_path=None):
+def _zip_add_file(zip_file, path, zip_path=None, compresslevel=6):
     permission = 0o555 if os.access(path, os.X_OK) else 0o444
     zip_info = zipfile.ZipInfo.from_file(path, zip_path)
     zip_info.date_time = (2019, 1, 1, 0, 0, 0)
     zip_info.external_attr = (stat.S_IFREG | permission) << 16
-    with open(path, "rb") as fp:
-        zip_file.writestr(
-            zip_info,
-            fp.read(),
-            compress_type=zipfile.ZIP_DEFLATED,
-            compresslevel=9,
-        )
+    zip_info.compress_type = _zip_compress_type(path)
+    zip_info._compresslevel = compresslevel
+    # file_size is known from the stat, so zipfile switches to zip64 by itself when needed
+    with zip_file.open(zip_info, 'w') as dest, open(path, "rb") as src:
+        shutil.copyfileobj(src, dest, _COPY_BUFSIZE)
 
 
-def zip_files(fps, dst, deterministic=False):
-    zf = zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED)
+def zip_files(fps, dst, deterministic=False, compresslevel=6):
+    zf = zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
     for fp in fps:
         fp = fmt_path(fp)
         if deterministic:
-            _zip_add_file(zf, str(fp), fp.name)
+            _zip_add_file(zf, str(fp), fp.name, compresslevel)
         else:
-            zf.write(str(fp), fp.name)
+            zf.write(str(fp), fp.name, compress_type=_zip_compress_type(fp.name))
     zf.close()
 
 
@@ -207,7 +304,20 @@ def _parse_response_filename(rep):
     return filename
 
 
-def download_file(url, dst, headers=None):
+def _copy_and_hash(fsrc, fdst, obj, length=_COPY_BUFSIZE):
+    while True:
+        buf = fsrc.read(length)
+        if not buf:
+            break
+        fdst.write(buf)
+        obj.update(buf)
+
+
+def download_file(url, dst, headers=None, hash_method=None):
+    if hash_method is not None:
+        # Deferred, hhutil.hash imports this module
+        from hhutil.hash import hash_ctor
+        obj = hash_ctor(hash_method)()
     dst = fmt_path(dst)
     if dst.exists() and dst.is_dir():
         dst_dir = dst
@@ -217,15 +327,19 @@ def download_file(url, dst, headers=None):
         filename = dst.name
     f = tempfile.NamedTemporaryFile(delete=False, dir=dst_dir)
     try:
-        with requests.get(url, stream=True, headers=headers) as r:
+        with _SESSION.get(url, stream=True, headers=headers) as r:
             r.raw.decode_content = True
-            shutil.copyfileobj(r.raw, f)
+            if hash_method is None:
+                shutil.copyfileobj(r.raw, f, _COPY_BUFSIZE)
+            else:
+                _copy_and_hash(r.raw, f, obj)
             if filename is None:
                 filename = _parse_response_filename(r)
         f.close()
         if filename is not None:
             dst = dst_dir / filename
-            shutil.move(f.name, dst)
+            # The temp file lives in dst_dir, so this is a same-filesystem rename
+            os.replace(f.name, dst)
         else:
             # Can't parse filename and target is dir, use temp file name
             pass
@@ -233,23 +347,24 @@ def download_file(url, dst, headers=None):
         f.close()
         if os.path.exists(f.name):
             os.remove(f.name)
+    if hash_method is not None:
+        return dst, obj.hexdigest()
     return dst
 
 
-def download_github_private_assert(url, dst, access_token):
-    p = r"https://github.com/([a-zA-Z0-9]+)/([a-z0-9A-Z-_]+)/releases/download/([a-zA-Z0-9\.]+)/(.*)"
-    m = re.match(p, url)
-    assert m is not None and len(m.groups()) == 4
-    repo = m.group(1) + "/" + m.group(2)
-    tag = m.group(3)
-    file = m.group(4)
+@lru_cache(maxsize=32)
+def resolve_release_assets(repo, tag, access_token):
     query_url = f"https://api.github.com/repos/{repo}/releases/tags/{tag}"
     headers = {
         "Authorization": f"token {access_token}",
         "Accept": "application/vnd.github.v3+json"
     }
-    req = requests.get(query_url, headers=headers)
-    asset_id = next(filter(lambda a: a['name'] == file, req.json()['assets']))['id']
+    req = _SESSION.get(query_url, headers=headers)
+    req.raise_for_status()
+    return MappingProxyType({a['name']: a['id'] for a in req.json()['assets']})
+
+
+def download_asset(repo, asset_id, access_token, dst):
     download_url = f"https://api.github.com/repos/{repo}/releases/assets/{asset_id}"
     headers = {
         "Authorization": f"token {access_token}",
@@ -258,9 +373,18 @@ def download_github_private_assert(url, dst, access_token):
     return download_file(download_url, dst, headers=headers)
 
 
+def download_github_private_assert(url, dst, access_token):
+    m = _GITHUB_RELEASE_RE.match(url)
+    assert m is not None and len(m.groups()) == 4
+    repo = m.group(1) + "/" + m.group(2)
+    tag = m.group(3)
+    file = m.group(4)
+    asset_id = resolve_release_assets(repo, tag, access_token)[file]
+    return download_asset(repo, asset_id, access_token, dst)
+
+
 def get_onedrive_download_url(share_url):
-    p = r"https://1drv\.ms/u/s!([0-9a-zA-Z-_]{28})\?e=[0-9a-zA-Z-_]{6}"
-    m = re.match(p, share_url)
+    m = _ONEDRIVE_RE.match(share_url)
     if m is None:
         raise ValueError("Error share url: %s" % share_url)
     share_id = m.group(1)